@@ -1,20 +1,41 @@
 #!/usr/bin/env python
 from errno import EIO, ENOENT
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from stat import S_IFDIR, S_IFREG
-from threading import Timer
+from threading import Event, Lock, RLock, Thread
 from time import time
 import functools as ft
+import itertools
 import logging
 import os
 import sys
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
-import requests
+import httpx
 
 BLOCK_SIZE = 2 ** 16
 
+POOL_SIZE = 64
+MAX_RETRIES = 3
+# seconds to wait on connecting to, reading from or writing to a server
+REQUEST_TIMEOUT = 60
+FETCH_WORKERS = 16
+READAHEAD_MAX = 2 ** 20
+# after this many back to back reads a file is treated as being streamed
+# and gets a wider read-ahead window, refilled in larger requests
+STREAMING_READS = 4
+STREAMING_READAHEAD_MAX = 2 ** 21
+# most blocks that may be prefetched at once, further read-ahead is dropped
+MAX_PREFETCH_BLOCKS = 32
+STREAM_CHUNK_SIZE = 2 ** 16
+# largest read the kernel is allowed to hand us in one request
+MAX_READ = 2 ** 20
+
 CLEANUP_INTERVAL = 60
 CLEANUP_EXPIRED = 60
+MAX_FILE_ENTRIES = 10000
+EVICTION_SAMPLES = 8
+HEAD_EXPIRED = 3600
 
 DISK_CACHE_SIZE_ENV = 'HTTPFS_DISK_CACHE_SIZE'
 DISK_CACHE_DIR_ENV = 'HTTPFS_DISK_CACHE_DIR'
@@ -22,23 +43,33 @@ DISK_CACHE_DIR_ENV = 'HTTPFS_DISK_CACHE_DIR'
 import collections
 import diskcache as dc
 
+log = logging.getLogger(__name__)
+
 class LRUCache:
     def __init__(self, capacity):
         self.capacity = capacity
         self.cache = collections.OrderedDict()
+        # FUSE and the fetch workers call in from several threads
+        self.lock = Lock()
 
     def __getitem__(self, key):
-        value = self.cache.pop(key)
-        self.cache[key] = value
-        return value
+        with self.lock:
+            self.cache.move_to_end(key)
+            return self.cache[key]
 
     def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            elif len(self.cache) >= self.capacity:
+                self.cache.popitem(last=False)
+            self.cache[key] = value
+
+    def get(self, key, default=None):
         try:
-            self.cache.pop(key)
+            return self[key]
         except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+            return default
 
     def __contains__(self, key):
         return key in self.cache
@@ -54,12 +85,49 @@ class HttpFs(LoggingMixIn, Operations):
     """
     def __init__(self, _schema, disk_cache_size=2**30, disk_cache_dir='/tmp/xx', lru_capacity=400):
         self.schema = _schema
+        self._url_prefix = f'{_schema}:/'
         self.files = dict()
-        self.cleanup_thread = self._generate_cleanup_thread(start=False)
+        # held for every insertion into / deletion from self.files
+        self.files_lock = Lock()
+        self.stop_cleanup = Event()
+        self.cleanup_thread = Thread(target=self._cleanup_loop, daemon=True)
         self.lru_cache = LRUCache(capacity=lru_capacity)
 
-        self.disk_cache = dc.Cache(disk_cache_dir, disk_cache_size)
-
+        # blocks go in as plain bytes, which diskcache stores without
+        # pickling; every block, short tail blocks included, gets its own
+        # file rather than an SQLite row
+        self.disk_cache = dc.Cache(
+            disk_cache_dir,
+            size_limit=disk_cache_size,
+            disk_min_file_size=0)
+        # HEAD results are small pickled dicts, so they get a cache of their
+        # own with default settings and stay inline in its SQLite rows
+        self.head_cache = dc.Cache(os.path.join(disk_cache_dir, 'head'))
+
+        # a single client keeps connections alive across range requests and,
+        # where the server supports it, multiplexes them over HTTP/2
+        transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=POOL_SIZE),
+            retries=MAX_RETRIES)
+        # block requests need raw byte offsets, a compressed body would
+        # make servers ignore Range and break the block arithmetic
+        self.client = httpx.Client(
+            transport=transport,
+            timeout=REQUEST_TIMEOUT,
+            headers={'Accept-Encoding': 'identity'},
+            follow_redirects=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        # block fetches that are currently running, keyed by cache key
+        self.inflight = dict()
+        self.inflight_lock = RLock()
+        self.prefetching = 0
+
+        # the counters are bumped from FUSE threads and fetch workers alike
+        self.stats_lock = Lock()
         self.lru_hits = 0
         self.lru_misses = 0
 
@@ -72,109 +140,230 @@ class HttpFs(LoggingMixIn, Operations):
     def getattr(self, path, fh=None):
         #logging.info("attr path: {}".format(path))
         
-        if path in self.files:
-            return self.files[path]['attr']
+        url = _parse_path(self._url_prefix, path)
 
-        elif path.endswith('..'):
-            url = '{}:/{}'.format(self.schema, path[:-2])
-            
-            # logging.info("attr url: {}".format(url))
-            head = requests.head(url, allow_redirects=True)
-            # logging.info("head: {}".format(head.headers))
-            # logging.info("status_code: {}".format(head.status_code))
+        if url is not None:
+            return self._file_entry(path, url)['attr']
+        else:
+            return dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
+
+    def _file_entry(self, path, url):
+        '''
+        Return the entry for a file in self.files, creating it if needed.
+        Callers should hold on to the returned dict rather than look it
+        up again, since another thread may evict it at any time.
+        '''
+        entry = self.files.get(path)
+
+        if entry is None:
+            # HEAD results outlive self.files (and restarts) in the disk cache
+            head = self.head_cache.get(url)
+
+            if head is None:
+                # logging.info("attr url: {}".format(url))
+                try:
+                    r = self.client.head(url)
+                except httpx.HTTPError as e:
+                    log.info("HEAD %s failed: %s", url, e)
+                    raise FuseOSError(EIO)
+                # logging.info("head: {}".format(r.headers))
+                # logging.info("status_code: {}".format(r.status_code))
+
+                # only successful responses are cached, an error page's
+                # length must not become the file's size
+                if r.status_code == 404:
+                    raise FuseOSError(ENOENT)
+                if not r.is_success:
+                    raise FuseOSError(EIO)
+
+                head = {
+                    'Content-Length': int(r.headers['Content-Length']),
+                    'ts': time()
+                }
+                self.head_cache.set(url, head, expire=HEAD_EXPIRED)
 
             attr = dict(
                 st_mode=(S_IFREG | 0o644), 
                 st_nlink=1,
-                st_size=int(head.headers['Content-Length']),
-                st_ctime=time(), 
-                st_mtime=time(),
+                st_size=head['Content-Length'],
+                st_ctime=head['ts'], 
+                st_mtime=head['ts'],
                 st_atime=time())
             
-            self.files[path] = dict(
+            entry = dict(
                 time=time(), 
-                attr=attr)
-            return attr
+                attr=attr,
+                last_block=-1,
+                readahead=0,
+                prefetched=-1,
+                next_offset=0,
+                sequential_reads=0)
 
-        else:
-            return dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
+            with self.files_lock:
+                if len(self.files) >= MAX_FILE_ENTRIES:
+                    self._evict_file()
+                self.files[path] = entry
+
+        return entry
 
     def read(self, path, size, offset, fh):
         #logging.info("read path: {}".format(path))
-        if path in self.files:
-            url = '{}:/{}'.format(self.schema, path[:-2])
-            logging.info("read url: {}".format(url))
-            logging.info("offset: {} - {} block: {}".format(offset, offset + size - 1, offset // 2 ** 18))
-            output = [0 for i in range(size)]
-
-            t1 = time()
+        url = _parse_path(self._url_prefix, path)
 
-            # nothing fetched yet
-            last_fetched = -1
-            curr_start = offset
-
-            while last_fetched < offset + size:
-                #print('curr_start', curr_start)
-                block_num = curr_start // BLOCK_SIZE
-                block_start = BLOCK_SIZE * (curr_start // BLOCK_SIZE)
+        if url is None:
+            log.info("file not found")
+            raise FuseOSError(EIO)
 
-                #print("block_num:", block_num, "block_start:", block_start)
-                block_data = self.get_block(url, block_num)
+        # skip building the messages unless debugging, this is the hot path
+        verbose = log.isEnabledFor(logging.DEBUG)
+        if verbose:
+            log.debug("read url: %s", url)
+            log.debug("offset: %s - %s block: %s",
+                      offset, offset + size - 1, offset // BLOCK_SIZE)
+
+        t1 = time()
+
+        first_block = offset // BLOCK_SIZE
+        last_block = (offset + size - 1) // BLOCK_SIZE
+
+        cached = None
+        entry = self.files.get(path)
+        if entry is None:
+            # the attributes are only needed once we go to the network, so
+            # reads that the block cache can serve don't wait for a HEAD
+            cached = self._lookup_blocks(
+                url, size, offset, first_block, last_block)
+            pieces, missing = cached
+            if not missing:
+                return b''.join(
+                    pieces[block_num]
+                    for block_num in range(first_block, last_block + 1))
+
+            entry = self._file_entry(path, url)
+
+        # reads at or past EOF never need to go to the server
+        size = min(size, entry['attr']['st_size'] - offset)
+        if size <= 0:
+            return b''
+        last_block = (offset + size - 1) // BLOCK_SIZE
 
-                data_start = curr_start - (curr_start // BLOCK_SIZE) * BLOCK_SIZE
-                data_end = min(BLOCK_SIZE, offset + size - block_start)
+        try:
+            if first_block == last_block and cached is None:
+                # the read fits in one block, so hand back a slice of it
+                # without assembling a separate output buffer
+                block_data = self.get_block(
+                    url, first_block, file_size=entry['attr']['st_size'])
+                data_start = offset - first_block * BLOCK_SIZE
+                output = bytes(block_data[data_start:data_start + size])
+            else:
+                output = self._read_blocks(
+                    url, size, offset, first_block, last_block,
+                    file_size=entry['attr']['st_size'], cached=cached)
+        except httpx.HTTPError as e:
+            log.info("fetching %s failed: %s", url, e)
+            raise FuseOSError(EIO)
 
-                data = block_data[data_start:data_end]
+        self._readahead(url, entry, offset, size, first_block, last_block)
 
-                #print("data_start:", data_start, data_end, data_end - data_start)
-                for (j,d) in enumerate(data):
-                    output[curr_start-offset+j] = d
+        t2 = time()
 
-                last_fetched = curr_start + (data_end - data_start)
-                curr_start += (data_end - data_start)
+        entry['time'] = t2  # extend life of cache entry
 
-            t2 = time()
+        if verbose:
+            log.debug("time: %.2f", t2 - t1)
+        return output
 
-            # logging.info("sending request")
-            # logging.info(url)
-            # logging.info(headers)
-            logging.info("lru hits: {} lru misses: {} disk hits: {} disk misses: {}"
-                    .format(self.lru_hits, self.lru_misses, self.disk_hits, self.disk_misses))
+    def _lookup_blocks(self, url, size, offset, first_block, last_block):
+        '''
+        Look a read's blocks up in the LRU and disk caches. Returns a dict
+        of block_num -> view of the part of the block the read needs, for
+        the blocks that were found, and a list of the missing block numbers.
+        '''
+        pieces = {}
+        missing = []
+        for block_num in range(first_block, last_block + 1):
+            block_data = self.get_cached_block(url, block_num)
+            if block_data is None:
+                missing.append(block_num)
+            else:
+                pieces[block_num] = self._block_slice(
+                    offset, size, block_num, block_data)
 
-            self.files[path]['time'] = t2  # extend life of cache entry
+        return pieces, missing
 
-            logging.info("time: {:.2f}".format(t2 - t1))
-            return bytes(output)
-            
+    def _read_blocks(self, url, size, offset, first_block, last_block,
+                     file_size=None, cached=None):
+        '''
+        Assemble a read spanning several blocks. Cached blocks are used
+        straight away and the rest are fetched concurrently, one request
+        per run of adjacent missing blocks. A (pieces, missing) result of
+        _lookup_blocks for this read can be passed as cached so the caches
+        aren't consulted a second time.
+
+        Only views into the blocks are collected; the single copy into
+        the returned bytes happens in one join call once they are all in.
+        '''
+        if cached is None:
+            pieces, missing = self._lookup_blocks(
+                url, size, offset, first_block, last_block)
         else:
-            logging.info("file not found")
-            raise FuseOSError(EIO)
+            # the read may since have been cut short at EOF
+            pieces, missing = cached
+            missing = [block_num for block_num in missing
+                       if block_num <= last_block]
+
+        futures = self._submit_fetch(url, missing, file_size=file_size)
+        for future in as_completed(set(futures.values())):
+            for block_num, block_data in future.result().items():
+                if futures.get(block_num) is future:
+                    self.lru_cache[(url, block_num)] = block_data
+                    pieces[block_num] = self._block_slice(
+                        offset, size, block_num, block_data)
+
+        return b''.join(
+            pieces[block_num] for block_num in range(first_block, last_block + 1))
 
     def destroy(self, path):
-        self.cleanup_thread.cancel()
+        self.stop_cleanup.set()
+        self.executor.shutdown(wait=False)
+        self.client.close()
 
     def cleanup(self):
         now = time()
-        num_files_before = len(self.files)
-        self.files = {
-            k: v for k, v in self.files.items() 
-                if now - v['time'] < CLEANUP_EXPIRED
-        }
-        num_files_after = len(self.files)
+        with self.files_lock:
+            num_files_before = len(self.files)
+            for k, v in list(self.files.items()):
+                if now - v['time'] >= CLEANUP_EXPIRED:
+                    del self.files[k]
+            num_files_after = len(self.files)
+
         if num_files_before != num_files_after:
-            logging.info(
-                'Truncated cache from {} to {} files'.format(
-                    num_files_before, num_files_after))
-        self.cleanup_thread = self._generate_cleanup_thread()
-
-    def _generate_cleanup_thread(self, start=True):
-        cleanup_thread = Timer(CLEANUP_INTERVAL, self.cleanup)
-        cleanup_thread.daemon = True
-        if start:
-            cleanup_thread.start()
-        return cleanup_thread
-
-    def get_block(self, url, block_num):
+            log.info(
+                'Truncated cache from %s to %s files',
+                num_files_before, num_files_after)
+        with self.stats_lock:
+            stats = (self.lru_hits, self.lru_misses,
+                     self.disk_hits, self.disk_misses)
+        log.info(
+            'lru hits: %s lru misses: %s disk hits: %s disk misses: %s',
+            *stats)
+
+    def _evict_file(self):
+        '''
+        Approximate LRU: of the first few entries in insertion order,
+        drop the one that was used least recently. Must be called with
+        files_lock held.
+        '''
+        sample = itertools.islice(self.files.items(), EVICTION_SAMPLES)
+        oldest = min(sample, key=lambda item: item[1]['time'])[0]
+        del self.files[oldest]
+
+    def _cleanup_loop(self):
+        # one long-lived thread rather than a new Timer every interval
+        while not self.stop_cleanup.wait(CLEANUP_INTERVAL):
+            self.cleanup()
+
+    def get_block(self, url, block_num, file_size=None):
         '''
         Get a data block from a URL. Blocks are 256K bytes in size
 
@@ -184,35 +373,291 @@ class HttpFs(LoggingMixIn, Operations):
             The url of the file we want to retrieve a block from
         block_num: int
             The # of the 256K'th block of this file
+        file_size: int
+            The size of the file, if known. Used to tell the file's short
+            final block apart from a truncated response.
         '''
-        cache_key=  "{}.{}".format(url, block_num)
-        cache = self.disk_cache
+        block_data = self.get_cached_block(url, block_num)
 
-        if cache_key in self.lru_cache:
-            self.lru_hits += 1
-            return self.lru_cache[cache_key]
-        else:
+        if block_data is None:
+            future = self._submit_fetch(
+                url, [block_num], file_size=file_size)[block_num]
+            block_data = future.result()[block_num]
+            self.lru_cache[(url, block_num)] = block_data
+
+        return block_data
+
+    def get_cached_block(self, url, block_num):
+        '''
+        Look a block up in the LRU and disk caches. Returns None
+        if the block has to be fetched.
+        '''
+        cache_key = (url, block_num)
+
+        block_data = self.lru_cache.get(cache_key)
+        if block_data is not None:
+            with self.stats_lock:
+                self.lru_hits += 1
+            return block_data
+
+        with self.stats_lock:
             self.lru_misses += 1
 
-            if cache_key in self.disk_cache:
+        # a single lookup rather than `in` followed by [] saves a
+        # round trip to the disk cache's database
+        block_data = self.disk_cache.get(cache_key)
+        if block_data is not None:
+            with self.stats_lock:
                 self.disk_hits += 1
-                block_data = self.disk_cache[cache_key]
-                self.lru_cache[cache_key] = block_data
-                return block_data
-            else:
-                self.disk_misses += 1
-                block_start = block_num * BLOCK_SIZE
-                
-                headers = {
-                    'Range': 'bytes={}-{}'.format(block_start, block_start + BLOCK_SIZE - 1)
-                }
-                r = requests.get(url, headers=headers)
-                block_data = r.content
-                self.lru_cache[cache_key] = block_data
-                self.disk_cache[cache_key] = block_data
+            self.lru_cache[cache_key] = block_data
 
         return block_data
 
+    def fetch_blocks(self, url, first_block, last_block, file_size=None):
+        '''
+        Fetch the blocks first_block..last_block (inclusive) with a single
+        range request and store each of them in the disk cache. Safe to
+        call from the executor's worker threads.
+
+        The file's size is taken from the response headers where they
+        give it, falling back to file_size otherwise.
+
+        Returns a dict of block_num -> block data.
+        '''
+        with self.stats_lock:
+            self.disk_misses += last_block - first_block + 1
+        range_start = first_block * BLOCK_SIZE
+        range_end = (last_block + 1) * BLOCK_SIZE
+
+        headers = {
+            'Range': f'bytes={range_start}-{range_end - 1}'
+        }
+        # stream the body into one preallocated buffer rather than
+        # buffering the whole response first
+        buf = bytearray(range_end - range_start)
+        length = 0
+
+        with self.client.stream('GET', url, headers=headers) as r:
+            # error pages must never end up in the disk cache
+            r.raise_for_status()
+            if r.status_code not in (200, 206):
+                raise httpx.HTTPStatusError(
+                    'Unexpected status {}'.format(r.status_code),
+                    request=r.request, response=r)
+
+            # servers that ignore Range send back the whole file, so skip
+            # ahead to the requested range and stop once it is filled
+            skip = range_start if r.status_code == 200 else 0
+            response_file_size = _response_file_size(r)
+            if response_file_size is not None:
+                file_size = response_file_size
+
+            for chunk in r.iter_bytes(chunk_size=STREAM_CHUNK_SIZE):
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+
+                chunk = memoryview(chunk)[skip:skip + len(buf) - length]
+                skip = 0
+                buf[length:length + len(chunk)] = chunk
+                length += len(chunk)
+
+                if length == len(buf):
+                    break
+
+        data = memoryview(buf)[:length]
+
+        blocks = {}
+        for block_num in range(first_block, last_block + 1):
+            data_start = (block_num - first_block) * BLOCK_SIZE
+            block_data = bytes(data[data_start:data_start + BLOCK_SIZE])
+
+            # only the file's final block may be short
+            expected = BLOCK_SIZE
+            if file_size is not None:
+                expected = max(0, min(BLOCK_SIZE, file_size - block_num * BLOCK_SIZE))
+            if len(block_data) != expected:
+                raise httpx.RemoteProtocolError(
+                    'Short response for block {} of {}'.format(block_num, url))
+
+            if block_data:
+                self.disk_cache[(url, block_num)] = block_data
+            blocks[block_num] = block_data
+
+        return blocks
+
+    def _submit_fetch(self, url, block_nums, prefetch=False, file_size=None):
+        '''
+        Fetch blocks in the background, coalescing adjacent blocks into
+        a single request and reusing fetches that are already running.
+
+        Prefetches are limited to MAX_PREFETCH_BLOCKS outstanding blocks;
+        blocks past that are not submitted.
+
+        Returns a dict of block_num -> future. Each future resolves
+        to a dict of block_num -> block data.
+        '''
+        futures = {}
+
+        with self.inflight_lock:
+            pending = []
+            for block_num in block_nums:
+                future = self.inflight.get((url, block_num))
+                if future is None:
+                    pending.append(block_num)
+                else:
+                    futures[block_num] = future
+
+            for first_block, last_block in _block_runs(pending):
+                num_prefetched = 0
+                if prefetch:
+                    last_block = min(
+                        last_block,
+                        first_block + MAX_PREFETCH_BLOCKS - self.prefetching - 1)
+                    if last_block < first_block:
+                        break
+                    num_prefetched = last_block - first_block + 1
+                    self.prefetching += num_prefetched
+
+                future = self.executor.submit(
+                    self._prefetch_blocks if prefetch else self.fetch_blocks,
+                    url, first_block, last_block, file_size)
+
+                cache_keys = []
+                for block_num in range(first_block, last_block + 1):
+                    cache_key = (url, block_num)
+                    self.inflight[cache_key] = future
+                    cache_keys.append(cache_key)
+                    futures[block_num] = future
+
+                future.add_done_callback(
+                    lambda f, cache_keys=cache_keys, n=num_prefetched:
+                        self._fetch_done(cache_keys, n))
+
+        return futures
+
+    def _fetch_done(self, cache_keys, num_prefetched):
+        with self.inflight_lock:
+            for cache_key in cache_keys:
+                self.inflight.pop(cache_key, None)
+            self.prefetching -= num_prefetched
+
+    def _prefetch_blocks(self, url, first_block, last_block, file_size=None):
+        '''
+        Like fetch_blocks, but blocks that are already in the disk cache
+        are not requested again.
+        '''
+        blocks = {}
+        missing = []
+        for block_num in range(first_block, last_block + 1):
+            block_data = self.disk_cache.get((url, block_num))
+            if block_data is None:
+                missing.append(block_num)
+            else:
+                blocks[block_num] = block_data
+
+        for run_first, run_last in _block_runs(missing):
+            blocks.update(
+                self.fetch_blocks(url, run_first, run_last, file_size))
+
+        return blocks
+
+    def _readahead(self, url, entry, offset, size, first_block, last_block):
+        '''
+        Prefetch the blocks following a sequential read into the disk
+        cache. The window doubles on every sequential read up to
+        READAHEAD_MAX bytes and is reset when the reader jumps.
+
+        Once STREAMING_READS reads in a row have started exactly where
+        the previous one ended, the window may grow to
+        STREAMING_READAHEAD_MAX and is only topped up when less than half
+        of it is left, so the file is fetched in fewer, larger requests.
+        A jump halves the streaming score.
+        '''
+        if offset == entry['next_offset']:
+            entry['sequential_reads'] = min(
+                entry['sequential_reads'] + 1, STREAMING_READS)
+        else:
+            entry['sequential_reads'] //= 2
+        entry['next_offset'] = offset + size
+        streaming = entry['sequential_reads'] >= STREAMING_READS
+
+        readahead_max = STREAMING_READAHEAD_MAX if streaming else READAHEAD_MAX
+
+        if 0 <= first_block - entry['last_block'] <= 1:
+            entry['readahead'] = min(
+                max(2 * entry['readahead'], 1), readahead_max // BLOCK_SIZE)
+        else:
+            entry['readahead'] = 0
+            entry['prefetched'] = -1
+        entry['last_block'] = last_block
+
+        if streaming and entry['prefetched'] - last_block > entry['readahead'] // 2:
+            return
+
+        num_blocks = (entry['attr']['st_size'] + BLOCK_SIZE - 1) // BLOCK_SIZE
+        start = max(last_block, entry['prefetched']) + 1
+        end = min(last_block + entry['readahead'] + 1, num_blocks)
+
+        if start < end:
+            futures = self._submit_fetch(
+                url, range(start, end), prefetch=True,
+                file_size=entry['attr']['st_size'])
+            if futures:
+                entry['prefetched'] = max(futures)
+
+    @staticmethod
+    def _block_slice(offset, size, block_num, block_data):
+        '''
+        Return a view of the part of a block that overlaps
+        [offset, offset + size). The last block of a file may be short.
+        '''
+        block_start = block_num * BLOCK_SIZE
+        data_start = max(offset - block_start, 0)
+        data_end = min(BLOCK_SIZE, offset + size - block_start)
+
+        return memoryview(block_data)[data_start:data_end]
+
+
+def _response_file_size(r):
+    '''
+    The full size of the file a GET response is for, or None if the
+    headers don't tell.
+    '''
+    if r.status_code == 206:
+        total = r.headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+    elif 'Content-Encoding' not in r.headers:
+        length = r.headers.get('Content-Length', '')
+        if length.isdigit():
+            return int(length)
+    return None
+
+
+@ft.lru_cache(maxsize=4096)
+def _parse_path(url_prefix, path):
+    '''
+    Map a path to the url it stands for. Files are marked by a trailing
+    '..', anything else is a directory and maps to None.
+    '''
+    if path.endswith('..'):
+        return url_prefix + path[:-2]
+    return None
+
+
+def _block_runs(block_nums):
+    '''
+    Group sorted block numbers into (first, last) runs of adjacent blocks.
+    '''
+    runs = []
+    for block_num in block_nums:
+        if runs and runs[-1][1] == block_num - 1:
+            runs[-1][1] = block_num
+        else:
+            runs.append([block_num, block_num])
+    return [tuple(run) for run in runs]
+
 
 def main():
     import argparse
@@ -233,12 +678,20 @@ def main():
         '--disk-cache-dir', default='/tmp/xx')
     parser.add_argument(
         '--lru-capacity', default=400, type=int)
+    parser.add_argument(
+        '--max-read', default=MAX_READ, type=int)
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='Log every read')
 
     args = vars(parser.parse_args())
 
-    logging.getLogger().setLevel(logging.INFO)
-    logging.info("starting:")
-    logging.info("foreground: {}".format(args['foreground']))
+    logging.basicConfig(
+        level=logging.DEBUG if args['verbose'] else logging.INFO)
+    log.info("starting:")
+    log.info("foreground: %s", args['foreground'])
     
     fuse = FUSE(
         HttpFs(args['schema'],
@@ -247,7 +700,9 @@ def main():
                lru_capacity=args['lru_capacity']
             ), 
         args['mountpoint'], 
-        foreground=args['foreground']
+        foreground=args['foreground'],
+        max_read=args['max_read'],
+        max_readahead=args['max_read']
     )
 
 